@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 # pylint: disable=W0201
+import os
 import sys
 import argparse
 import yaml
@@ -50,18 +51,40 @@ class IO():
         self.arg = parser.parse_args(argv)
 
     def init_environment(self):
+        # gpu, made visible and selected before anything starts cuda, so
+        # that LOCAL_RANK indexes into the --device list
+        if self.arg.use_gpu:
+            gpus = torchlight.visible_gpu(self.arg.device)
+            if self.arg.distributed:
+                gpus = [int(os.environ['LOCAL_RANK'])]
+                torch.cuda.set_device(gpus[0])
+
+        # distributed, one process per gpu launched by torchrun
+        self.rank = 0
+        if self.arg.distributed:
+            torch.distributed.init_process_group(
+                'nccl' if self.arg.use_gpu else 'gloo')
+            self.rank = torch.distributed.get_rank()
+
+        # only the first process writes logs and files
         self.io = torchlight.IO(
             self.arg.work_dir,
-            save_log=self.arg.save_log,
-            print_log=self.arg.print_log)
-        self.io.save_arg(self.arg)
+            save_log=self.arg.save_log and self.rank == 0,
+            print_log=self.arg.print_log and self.rank == 0)
+        if self.rank == 0:
+            self.io.save_arg(self.arg)
 
-        # gpu
         if self.arg.use_gpu:
-            gpus = torchlight.visible_gpu(self.arg.device)
             torchlight.occupy_gpu(gpus)
             self.gpus = gpus
-            self.dev = "cuda:0"
+
+            # input shapes are fixed, so cudnn can benchmark its kernels once
+            # and reuse the fastest; tf32 is used by convs and matmuls on ampere
+            torch.backends.cudnn.benchmark = not self.arg.deterministic
+            torch.backends.cudnn.deterministic = self.arg.deterministic
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+            self.dev = "cuda:{}".format(gpus[0])
         else:
             self.dev = "cpu"
 
@@ -83,9 +106,18 @@ class IO():
                 setattr(self, name, value.to(self.dev))
 
         # model parallel
-        if self.arg.use_gpu and len(self.gpus) > 1:
+        if self.arg.distributed:
+            self.model = nn.parallel.DistributedDataParallel(
+                self.model,
+                device_ids=self.gpus if self.arg.use_gpu else None)
+        elif self.arg.use_gpu and len(self.gpus) > 1:
             self.model = nn.DataParallel(self.model, device_ids=self.gpus)
 
+        # graph compilation, without cuda graphs so that the smaller last
+        # batch of an epoch does not trigger re-capturing
+        if self.arg.compile:
+            self.model = torch.compile(self.model, mode='default')
+
     def start(self):
         self.io.print_log('Parameters:\n{}\n'.format(str(vars(self.arg))))
 
@@ -102,6 +134,8 @@ class IO():
         # processor
         parser.add_argument('--use_gpu', type=str2bool, default=True, help='use GPUs or not')
         parser.add_argument('--device', type=int, default=0, nargs='+', help='the indexes of GPUs for training or testing')
+        parser.add_argument('--distributed', type=str2bool, default=False, help='use DistributedDataParallel with one process per GPU (launch with torchrun)')
+        parser.add_argument('--deterministic', type=str2bool, default=False, help='use deterministic cudnn algorithms instead of benchmarking for the fastest')
 
         # visulize and debug
         parser.add_argument('--print_log', type=str2bool, default=True, help='print logging or not')
@@ -112,6 +146,7 @@ class IO():
         parser.add_argument('--model_args', action=DictAction, default=dict(), help='the arguments of model')
         parser.add_argument('--weights', default=None, help='the weights for network initialization')
         parser.add_argument('--ignore_weights', type=str, default=[], nargs='+', help='the name of weights which will be ignored in the initialization')
+        parser.add_argument('--compile', type=str2bool, default=False, help='compile the model with torch.compile or not')
         #endregion yapf: enable
 
         return parser
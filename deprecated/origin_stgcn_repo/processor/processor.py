@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 # pylint: disable=W0201
+import os
 import sys
 import argparse
+import functools
+import random
 import yaml
 import numpy as np
 
@@ -18,6 +21,29 @@ from torchlight import import_class
 
 from .io import IO
 
+def collate(batch, dtype=torch.float32):
+    """
+        Stack a batch of (data, label) and cast the data in the worker,
+        so that it is copied to the gpu in the dtype and the contiguous
+        (N, C, T, V, M) layout the model consumes
+    """
+    data, label = torch.utils.data.dataloader.default_collate(batch)
+    assert data.dim() == 5, 'data should be of shape (N, C, T, V, M)'
+    return data.to(dtype).contiguous(), label
+
+def worker_init(worker_id):
+    """
+        Keep torch single-threaded in each data loader worker, since the
+        workers already run in parallel and would otherwise oversubscribe
+        the cpus, and seed numpy and random from the per-worker torch seed,
+        so that workers do not share the augmentation state forked from
+        the parent
+    """
+    torch.set_num_threads(1)
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
 class Processor(IO):
     """
         Base Processor
@@ -41,6 +67,15 @@ class Processor(IO):
         self.epoch_info = dict()
         self.meta_info = dict(epoch=0, iter=0)
 
+        # seed once, data loader workers derive their seeds from torch; each
+        # process gets its own seed so that augmentations differ across
+        # ranks, ddp broadcasts the initial weights of rank 0 anyway
+        seed = self.arg.seed + self.rank
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        torch.cuda.manual_seed_all(seed)
+
     def load_optimizer(self):
         pass
 
@@ -48,28 +83,68 @@ class Processor(IO):
         Feeder = import_class(self.arg.feeder)
         if 'debug' not in self.arg.train_feeder_args:
             self.arg.train_feeder_args['debug'] = self.arg.debug
+        # no more workers than cpus that are available to this process
+        if hasattr(os, 'sched_getaffinity'):
+            num_cpu = len(os.sched_getaffinity(0))
+        else:
+            num_cpu = os.cpu_count() or 1
+        if self.arg.distributed:
+            num_worker = self.arg.num_worker
+            num_cpu //= int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+        else:
+            num_worker = self.arg.num_worker * torchlight.ngpu(
+                self.arg.device)
+        num_worker = min(num_worker, max(num_cpu, 1))
+        # under amp, data is sent as half to halve the host to gpu traffic
+        dtype = torch.float16 if (self.arg.amp
+                                  and self.arg.use_gpu) else torch.float32
+        loader_args = dict(num_workers=num_worker,
+                           pin_memory=self.arg.use_gpu,
+                           collate_fn=functools.partial(collate, dtype=dtype),
+                           worker_init_fn=worker_init)
+        if num_worker > 0:
+            # keep workers alive across epochs instead of re-forking them
+            loader_args.update(persistent_workers=True, prefetch_factor=2)
         self.data_loader = dict()
         if self.arg.phase == 'train':
+            dataset = Feeder(**self.arg.train_feeder_args)
+            if self.arg.distributed:
+                # each process samples its own shard of the training set
+                # and takes its share of the batch
+                # the sampler seed must be the same on every rank so that
+                # the shards stay disjoint
+                sampler = torch.utils.data.distributed.DistributedSampler(
+                    dataset, shuffle=True, seed=self.arg.seed)
+                world_size = torch.distributed.get_world_size()
+                if self.arg.batch_size % world_size != 0:
+                    raise ValueError(
+                        'batch_size ({}) must be divisible by the number of '
+                        'processes ({}).'.format(self.arg.batch_size,
+                                                 world_size))
+                batch_size = self.arg.batch_size // world_size
+            else:
+                sampler = None
+                batch_size = self.arg.batch_size
             self.data_loader['train'] = torch.utils.data.DataLoader(
-                dataset=Feeder(**self.arg.train_feeder_args),
-                batch_size=self.arg.batch_size,
-                shuffle=True,
-                num_workers=self.arg.num_worker * torchlight.ngpu(
-                    self.arg.device),
-                drop_last=True)
+                dataset=dataset,
+                batch_size=batch_size,
+                shuffle=sampler is None,
+                sampler=sampler,
+                drop_last=True,
+                **loader_args)
         if self.arg.test_feeder_args:
             self.data_loader['test'] = torch.utils.data.DataLoader(
                 dataset=Feeder(**self.arg.test_feeder_args),
                 batch_size=self.arg.test_batch_size,
                 shuffle=False,
-                num_workers=self.arg.num_worker * torchlight.ngpu(
-                    self.arg.device))
+                **loader_args)
 
     def show_epoch_info(self):
         for k, v in self.epoch_info.items():
             self.io.print_log('\t{}: {}'.format(k, v))
         if self.arg.pavi_log:
             self.io.log('train', self.meta_info['iter'], self.epoch_info)
+        self.io.flush_log()
 
     def show_iter_info(self):
         if self.meta_info['iter'] % self.arg.log_interval == 0:
@@ -101,50 +176,60 @@ class Processor(IO):
         self.show_epoch_info()
 
     def start(self):
-        self.io.print_log('Parameters:\n{}\n'.format(str(vars(self.arg))))
-
-        # training phase
-        if self.arg.phase == 'train':
-            for epoch in range(self.arg.start_epoch, self.arg.num_epoch):
-                self.meta_info['epoch'] = epoch
-
-                # training
-                self.io.print_log('Training epoch: {}'.format(epoch))
-                self.train()
-                self.io.print_log('Done.')
+        # buffered log lines reach log.txt even if the run fails
+        try:
+            self.io.print_log('Parameters:\n{}\n'.format(str(vars(self.arg))))
+
+            # training phase
+            if self.arg.phase == 'train':
+                for epoch in range(self.arg.start_epoch, self.arg.num_epoch):
+                    self.meta_info['epoch'] = epoch
+
+                    # training
+                    self.io.print_log('Training epoch: {}'.format(epoch))
+                    self.train()
+                    self.io.print_log('Done.')
 
-                # save model
-                if ((epoch + 1) % self.arg.save_interval == 0) or (
-                        epoch + 1 == self.arg.num_epoch):
-                    filename = 'epoch{}_model.pt'.format(epoch + 1)
-                    self.io.save_model(self.model, filename)
+                    # save model
+                    if self.rank == 0 and (
+                            (epoch + 1) % self.arg.save_interval == 0 or
+                            epoch + 1 == self.arg.num_epoch):
+                        filename = 'epoch{}_model.pt'.format(epoch + 1)
+                        self.io.save_model(self.model, filename)
+
+                    # evaluation
+                    if ((epoch + 1) % self.arg.eval_interval == 0) or (
+                            epoch + 1 == self.arg.num_epoch):
+                        self.io.print_log('Eval epoch: {}'.format(epoch))
+                        self.test()
+                        self.io.print_log('Done.')
+
+                # wait for the last checkpoint to be written
+                self.io.wait_save()
+            # test phase
+            elif self.arg.phase == 'test':
+
+                # the path of weights must be appointed
+                if self.arg.weights is None:
+                    raise ValueError('Please appoint --weights.')
+                self.io.print_log('Model:   {}.'.format(self.arg.model))
+                self.io.print_log('Weights: {}.'.format(self.arg.weights))
 
                 # evaluation
-                if ((epoch + 1) % self.arg.eval_interval == 0) or (
-                        epoch + 1 == self.arg.num_epoch):
-                    self.io.print_log('Eval epoch: {}'.format(epoch))
-                    self.test()
-                    self.io.print_log('Done.')
-        # test phase
-        elif self.arg.phase == 'test':
-
-            # the path of weights must be appointed
-            if self.arg.weights is None:
-                raise ValueError('Please appoint --weights.')
-            self.io.print_log('Model:   {}.'.format(self.arg.model))
-            self.io.print_log('Weights: {}.'.format(self.arg.weights))
-
-            # evaluation
-            self.io.print_log('Evaluation Start:')
-            self.test()
-            self.io.print_log('Done.\n')
-
-            # save the output of model
-            if self.arg.save_result:
-                result_dict = dict(
-                    zip(self.data_loader['test'].dataset.sample_name,
-                        self.result))
-                self.io.save_pkl(result_dict, 'test_result.pkl')
+                self.io.print_log('Evaluation Start:')
+                self.test()
+                self.io.print_log('Done.\n')
+
+                # save the output of model
+                if self.arg.save_result and self.rank == 0:
+                    result_dict = dict(
+                        zip(self.data_loader['test'].dataset.sample_name,
+                            self.result))
+                    self.io.save_pkl(result_dict, 'test_result.pkl')
+        finally:
+            self.io.flush_log()
+            if self.arg.distributed:
+                torch.distributed.destroy_process_group()
 
     @staticmethod
     def get_parser(add_help=False):
@@ -163,6 +248,10 @@ class Processor(IO):
         parser.add_argument('--num_epoch', type=int, default=80, help='stop training in which epoch')
         parser.add_argument('--use_gpu', type=str2bool, default=True, help='use GPUs or not')
         parser.add_argument('--device', type=int, default=0, nargs='+', help='the indexes of GPUs for training or testing')
+        parser.add_argument('--distributed', type=str2bool, default=False, help='use DistributedDataParallel with one process per GPU (launch with torchrun)')
+        parser.add_argument('--deterministic', type=str2bool, default=False, help='use deterministic cudnn algorithms instead of benchmarking for the fastest')
+        parser.add_argument('--seed', type=int, default=1, help='random seed for pytorch, numpy and random')
+        parser.add_argument('--amp', type=str2bool, default=False, help='use automatic mixed precision or not')
 
         # visulize and debug
         parser.add_argument('--log_interval', type=int, default=100, help='the interval for printing messages (#iteration)')
@@ -186,6 +275,7 @@ class Processor(IO):
         parser.add_argument('--model_args', action=DictAction, default=dict(), help='the arguments of model')
         parser.add_argument('--weights', default=None, help='the weights for network initialization')
         parser.add_argument('--ignore_weights', type=str, default=[], nargs='+', help='the name of weights which will be ignored in the initialization')
+        parser.add_argument('--compile', type=str2bool, default=False, help='compile the model with torch.compile or not')
         #endregion yapf: enable
 
         return parser
@@ -2,6 +2,8 @@
 # pylint: disable=W0201
 import sys
 import argparse
+import contextlib
+import warnings
 import yaml
 import numpy as np
 
@@ -44,6 +46,8 @@ class REC_Processor(Processor):
         self.loss = nn.CrossEntropyLoss()
         
     def load_optimizer(self):
+        if self.arg.accum_steps < 1:
+            raise ValueError('accum_steps must be at least 1.')
         if self.arg.optimizer == 'SGD':
             self.optimizer = optim.SGD(
                 self.model.parameters(),
@@ -58,52 +62,84 @@ class REC_Processor(Processor):
                 weight_decay=self.arg.weight_decay)
         else:
             raise ValueError()
-
-    def adjust_lr(self):
-        if self.arg.optimizer == 'SGD' and self.arg.step:
-            lr = self.arg.base_lr * (
-                0.1**np.sum(self.meta_info['epoch']>= np.array(self.arg.step)))
-            for param_group in self.optimizer.param_groups:
-                param_group['lr'] = lr
-            self.lr = lr
+        # torch.amp.GradScaler is only available from torch 2.3
+        amp = self.arg.amp and self.arg.use_gpu
+        if hasattr(torch.amp, 'GradScaler'):
+            self.scaler = torch.amp.GradScaler('cuda', enabled=amp)
         else:
-            self.lr = self.arg.base_lr
+            self.scaler = torch.cuda.amp.GradScaler(enabled=amp)
+
+        # the learning rate decays at the given steps with SGD only
+        milestones = self.arg.step if self.arg.optimizer == 'SGD' else []
+        self.scheduler = optim.lr_scheduler.MultiStepLR(
+            self.optimizer, milestones=milestones, gamma=0.1)
+
+        # catch up with the schedule when training resumes from start_epoch,
+        # before any optimizer step, which the scheduler would warn about
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            for _ in range(self.arg.start_epoch):
+                self.scheduler.step()
 
     def show_topk(self, k):
-        rank = self.result.argsort()
-        hit_top_k = [l in rank[i, -k:] for i, l in enumerate(self.label)]
-        accuracy = sum(hit_top_k) * 1.0 / len(hit_top_k)
+        accuracy = self.hit[:, :k].any(dim=1).float().mean().item()
         self.io.print_log('\tTop{}: {:.2f}%'.format(k, 100 * accuracy))
 
     def train(self):
         self.model.train()
-        self.adjust_lr()
+        self.lr = self.scheduler.get_last_lr()[0]
         loader = self.data_loader['train']
-        loss_value = []
+        if self.arg.distributed:
+            loader.sampler.set_epoch(self.meta_info['epoch'])
+        # accumulate the loss on device, reading it back only when logging
+        loss_sum = torch.zeros((), device=self.dev)
+        num_iter = 0
+        self.optimizer.zero_grad(set_to_none=True)
 
-        for data, label in loader:
+        for batch_idx, (data, label) in enumerate(loader):
 
             # get data
-            data = data.float().to(self.dev)
-            label = label.long().to(self.dev)
-
-            # forward
-            output = self.model(data)
-            loss = self.loss(output, label)
-
-            # backward
-            self.optimizer.zero_grad()
-            loss.backward()
-            self.optimizer.step()
+            data = data.to(self.dev, non_blocking=True)
+            label = label.to(self.dev, dtype=torch.long, non_blocking=True)
+
+            # gradients are accumulated over accum_steps batches, and only
+            # all-reduced across processes on the batch that steps; the last
+            # window of the epoch may be shorter and steps on the last batch
+            window_start = batch_idx - batch_idx % self.arg.accum_steps
+            window = min(self.arg.accum_steps, len(loader) - window_start)
+            step = (batch_idx + 1) % self.arg.accum_steps == 0 or (
+                batch_idx + 1 == len(loader))
+            if self.arg.distributed and not step:
+                sync = self.model.no_sync()
+            else:
+                sync = contextlib.nullcontext()
+
+            with sync:
+                # forward
+                with torch.autocast('cuda',
+                                    enabled=self.scaler.is_enabled()):
+                    output = self.model(data)
+                    loss = self.loss(output, label)
+
+                # backward
+                self.scaler.scale(loss / window).backward()
+
+            if step:
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+                self.optimizer.zero_grad(set_to_none=True)
 
             # statistics
-            self.iter_info['loss'] = loss.data.item()
+            loss_sum += loss.detach()
+            num_iter += 1
+            if self.meta_info['iter'] % self.arg.log_interval == 0:
+                self.iter_info['loss'] = loss.item()
             self.iter_info['lr'] = '{:.6f}'.format(self.lr)
-            loss_value.append(self.iter_info['loss'])
             self.show_iter_info()
             self.meta_info['iter'] += 1
 
-        self.epoch_info['mean_loss']= np.mean(loss_value)
+        self.scheduler.step()
+        self.epoch_info['mean_loss']= loss_sum.item() / max(num_iter, 1)
         self.show_epoch_info()
         self.io.print_timer()
 
@@ -112,33 +148,48 @@ class REC_Processor(Processor):
         self.model.eval()
         loader = self.data_loader['test']
         loss_value = []
-        result_frag = []
-        label_frag = []
-
-        for data, label in loader:
-            
-            # get data
-            data = data.float().to(self.dev)
-            label = label.long().to(self.dev)
-
-            # inference
-            with torch.no_grad():
-                output = self.model(data)
-            result_frag.append(output.data.cpu().numpy())
-
-            # get loss
-            if evaluation:
-                loss = self.loss(output, label)
-                loss_value.append(loss.item())
-                label_frag.append(label.data.cpu().numpy())
 
-        self.result = np.concatenate(result_frag)
+        # scores and labels of the whole test set are written into buffers
+        # allocated once on device, and copied to host when the loop ends
+        num_sample = len(loader.dataset)
+        score = None
+        label_all = torch.empty(num_sample, dtype=torch.long, device=self.dev)
+        index = 0
+
+        # no autograd bookkeeping at all for evaluation
+        with torch.inference_mode():
+            for data, label in loader:
+
+                # get data
+                data = data.to(self.dev, non_blocking=True)
+                label = label.to(self.dev, dtype=torch.long, non_blocking=True)
+
+                # inference
+                with torch.autocast('cuda', enabled=self.scaler.is_enabled()):
+                    output = self.model(data).float()
+                if score is None:
+                    score = torch.empty(num_sample,
+                                        output.size(1),
+                                        device=self.dev)
+                n = output.size(0)
+                score[index:index + n] = output
+                label_all[index:index + n] = label
+                index += n
+
+                # get loss
+                if evaluation:
+                    loss = self.loss(output, label)
+                    loss_value.append(loss)
+
+        self.result = score.cpu().numpy()
         if evaluation:
-            self.label = np.concatenate(label_frag)
-            self.epoch_info['mean_loss']= np.mean(loss_value)
+            self.epoch_info['mean_loss']= torch.stack(loss_value).mean().item()
             self.show_epoch_info()
 
-            # show top-k accuracy
+            # show top-k accuracy, ranked on device
+            maxk = min(max(self.arg.show_topk), score.size(1))
+            rank = score.topk(maxk, dim=1).indices
+            self.hit = rank == label_all.unsqueeze(1)
             for k in self.arg.show_topk:
                 self.show_topk(k)
 
@@ -161,6 +212,7 @@ class REC_Processor(Processor):
         parser.add_argument('--optimizer', default='SGD', help='type of optimizer')
         parser.add_argument('--nesterov', type=str2bool, default=True, help='use nesterov or not')
         parser.add_argument('--weight_decay', type=float, default=0.0001, help='weight decay for optimizer')
+        parser.add_argument('--accum_steps', type=int, default=1, help='the number of batches to accumulate gradients over before each optimizer step')
         # endregion yapf: enable
 
         return parser
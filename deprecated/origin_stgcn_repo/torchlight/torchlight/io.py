@@ -4,8 +4,10 @@ import os
 import sys
 import traceback
 import time
+import concurrent.futures
 import warnings
 import pickle
+import zipfile
 from collections import OrderedDict
 import yaml
 import numpy as np
@@ -29,7 +31,16 @@ class IO():
         self.pavi_logger = None
         self.session_file = None
         self.model_text = ''
-        
+        self.log_file = None
+        self.save_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.save_future = None
+        self.save_path = None
+
+    def __del__(self):
+        self.save_pool.shutdown(wait=True)
+        if self.log_file is not None:
+            self.log_file.close()
+
     # PaviLogger is removed in this version
     def log(self, *args, **kwargs):
         pass
@@ -61,7 +72,12 @@ class IO():
             ignore_weights = [ignore_weights]
 
         self.print_log('Load weights from {}.'.format(weights_path))
-        weights = torch.load(weights_path)
+        # checkpoints in the zip format are memory-mapped instead of read
+        # into memory, the released st-gcn weights use the legacy format
+        weights = torch.load(weights_path,
+                             map_location='cpu',
+                             weights_only=True,
+                             mmap=zipfile.is_zipfile(weights_path))
         weights = OrderedDict([[k.split('module.')[-1],
                                 v.cpu()] for k, v in weights.items()])
 
@@ -101,10 +117,27 @@ class IO():
     def save_model(self, model, name):
         model_path = '{}/{}'.format(self.work_dir, name)
         state_dict = model.state_dict()
-        weights = OrderedDict([[''.join(k.split('module.')),
-                                v.cpu()] for k, v in state_dict.items()])
-        torch.save(weights, model_path)
-        self.print_log('The model has been saved as {}.'.format(model_path))
+        # strip the prefixes added by DataParallel and torch.compile, and
+        # snapshot the weights on cpu so that training can go on
+        weights = OrderedDict([[''.join(k.split('module.')).replace('_orig_mod.', ''),
+                                v.detach().to('cpu', copy=True)]
+                               for k, v in state_dict.items()])
+
+        # serialization and disk io run in the background, one save at a
+        # time, and errors of the previous save are raised here; logging
+        # stays on the calling thread
+        self.wait_save()
+        self.print_log('Saving the model as {}.'.format(model_path))
+        self.save_future = self.save_pool.submit(torch.save, weights,
+                                                 model_path)
+        self.save_path = model_path
+
+    def wait_save(self):
+        if self.save_future is not None:
+            self.save_future.result()
+            self.save_future = None
+            self.print_log('The model has been saved as {}.'.format(
+                self.save_path))
 
     def save_arg(self, arg):
 
@@ -126,8 +159,14 @@ class IO():
         if self.print_to_screen:
             print(str)
         if self.save_log:
-            with open('{}/log.txt'.format(self.work_dir), 'a') as f:
-                print(str, file=f)
+            # opened once, written out by flush_log
+            if self.log_file is None:
+                self.log_file = open('{}/log.txt'.format(self.work_dir), 'a')
+            print(str, file=self.log_file)
+
+    def flush_log(self):
+        if self.log_file is not None:
+            self.log_file.flush()
 
     def init_timer(self, *name):
         self.record_time()